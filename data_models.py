@@ -1,10 +1,14 @@
-from pydantic import BaseModel, Field, PrivateAttr, computed_field
-from pydantic.types import List, Annotated
-from pydantic.networks import IPv4Address
+from dataclasses import dataclass, field
+from ipaddress import IPv4Address
 from datetime import datetime
-from uuid import uuid4, UUID
+from typing import Iterable, Optional
+from secrets import token_hex
+from operator import attrgetter
+from collections import deque
+import os
 import shutil
 import logging
+import msgspec
 
 log = logging.getLogger(__name__)
 logging.basicConfig(filename="ssoh.log", format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
@@ -13,23 +17,52 @@ logging.basicConfig(filename="ssoh.log", format='%(asctime)s | %(name)s | %(leve
 log.addHandler(logging.StreamHandler())
 
 
-class PingEvent(BaseModel):
+def _new_event_uuid() -> str:
+    """
+    Generates a random 128 bit id formatted like uuid4().hex, without building a UUID object
+    """
+    return token_hex(16)
+
+
+@dataclass(slots=True, frozen=True)
+class PingEvent:
     """
     PingEvent represents a single instance where the application pinged one target
 
     Attributes:
-        event_uuid: A UUID4 representing one single event. Generated automatically
         timestamp: The timestamp when the ping occurred
         ping: ping in ms
         failure: shows if ping failed
+        event_uuid: A random 128 bit hex id representing one single event. Generated automatically
     """
-    event_uuid: str = Field(default_factory=lambda: uuid4().hex)
     timestamp: datetime
-    ping: float = Field(ge=0)
-    failure: bool = Field(default=True)
+    ping: float
+    failure: bool = True
+    event_uuid: str = field(default_factory=_new_event_uuid)
+
+
+@dataclass(slots=True)
+class PingListSchema:
+    """
+    Layout of the MessagePack and json Files written by older versions
+    """
+    target: str
+    pings: list[PingEvent]
+
+
+# encoder and decoder are built once and shared by all PingLists
+PINGEVENT_ENCODER = msgspec.json.Encoder()
+PINGEVENT_DECODER = msgspec.json.Decoder(PingEvent)
+# only used to migrate files written by older versions
+LEGACY_DECODERS = ((".msgpack", msgspec.msgpack.Decoder(PingListSchema)),
+                   (".json", msgspec.json.Decoder(PingListSchema)))
+# number of pings kept per PingList
+MAX_PINGS = 5
+# number of events after which the ping log is rewritten with only the latest pings
+COMPACT_AFTER = 20
 
 
-class PingList(BaseModel):
+class PingList:
     """
     PingList is a collection of PingEvent objects for a specific ip address
 
@@ -38,39 +71,72 @@ class PingList(BaseModel):
         target: target ip address
 
     """
-    pings: List[PingEvent] = Field(default=[])
-    target: IPv4Address
+    __slots__ = ("target", "_events", "_uuid_set", "_failure_count", "_pending", "_logged_events", "_rewrite_log")
+
+    def __init__(self, target: IPv4Address, pings: Iterable[PingEvent] = ()):
+        self.target: IPv4Address = IPv4Address(target)
+        # pings added since the last load or save, these are appended to the ping log by save()
+        self._pending: list[PingEvent] = []
+        # number of events in the ping log, used to decide when to compact it
+        self._logged_events: int = 0
+        # forces the next save() to rewrite the ping log instead of appending to it
+        self._rewrite_log: bool = False
+        self._set_events(pings)
+
+    @property
+    def pings(self) -> list[PingEvent]:
+        """
+        The pings of the PingList, oldest first
+        """
+        return list(self._events)
+
+    def _set_events(self, events: Iterable[PingEvent]):
+        """
+        Replaces the stored events and rebuilds the uuid cache and the failure count
+
+        Args:
+            events: the events to store, only the latest MAX_PINGS are kept
+        """
+        self._events: deque[PingEvent] = deque(events, maxlen=MAX_PINGS)
+        self._uuid_set: set[str] = {event.event_uuid for event in self._events}
+        # number of failed pings in the list, kept up to date by add_ping_event
+        self._failure_count: int = sum(event.failure for event in self._events)
 
     def add_ping_event(self, ping: PingEvent):
         """
-        Adds a PingEvent to the PingList
+        Adds a PingEvent to the PingList, dropping the oldest PingEvent once MAX_PINGS are stored
 
         Args:
             ping: a fully instantiated PingEvent object
         """
         # check if ping already exists in list
-        for existing_ping in self.pings:
-            if existing_ping.event_uuid == ping.event_uuid:
-                log.warning(f"Ping already exists for {ping.event_uuid}. Not adding Ping")
-                return
-        # sort pings based on timestamp
-        self.pings.sort(key=lambda sorted_ping: sorted_ping.timestamp)
-        # delete pings more than 4
-        while len(self.pings) >= 5:
-            self.pings.pop(0)
+        if ping.event_uuid in self._uuid_set:
+            log.warning(f"Ping already exists for {ping.event_uuid}. Not adding Ping")
+            return
+        # the deque drops the oldest ping on append once it is full, so its counts are removed first
+        if len(self._events) == MAX_PINGS:
+            dropped_ping = self._events[0]
+            self._uuid_set.discard(dropped_ping.event_uuid)
+            self._failure_count -= dropped_ping.failure
         # append new ping
-        self.pings.append(ping)
+        self._events.append(ping)
+        self._uuid_set.add(ping.event_uuid)
+        self._failure_count += ping.failure
+        self._pending.append(ping)
 
-    def add_ping(self, failure: bool, latency: float = 9999999, timestamp=datetime.now()):
+    def add_ping(self, failure: bool, latency: float = 9999999, timestamp: Optional[datetime] = None):
         """
         Creates a PingEvent based on ping details and appends it to the PingList
 
         Args:
             failure: boolean indicating whether the ping failed
             latency: latency of the ping
-            timestamp: timestamp of the ping
+            timestamp: timestamp of the ping. defaults to the current time
         """
-        self.add_ping_event(PingEvent(timestamp=timestamp, target=self.target, ping=latency, failure=failure))
+        # evaluated per call, a default in the signature would be frozen at import time
+        if timestamp is None:
+            timestamp = datetime.now()
+        self.add_ping_event(PingEvent(timestamp=timestamp, ping=latency, failure=failure))
 
     def get_valid_percentage(self) -> float:
         """
@@ -80,27 +146,24 @@ class PingList(BaseModel):
              a simple float between 0 and 1 indicating the percentage of valid pings
              if no pings were found the percentage is 1.0 (100%)
         """
-        # get count of PingEvents where failure is False
-        valid_events = sum(not ping.failure for ping in self.pings)
         # prevent zero division
-        if len(self.pings) == 0:
+        if not self._events:
             return 1
-        return valid_events / len(self.pings)
+        return 1 - self._failure_count / len(self._events)
 
     def did_latest_fail(self) -> bool:
         """
-        Sorts array and checks if the latest ping failed
+        Checks if the latest ping failed
 
         Returns: True if latest ping failed; False otherwise
         """
-        # sort pings based on timestamp
-        self.pings.sort(key=lambda sorted_ping: sorted_ping.timestamp)
-        return self.pings[-1].failure
+        return max(self._events, key=attrgetter("timestamp")).failure
 
     @classmethod
     def load(cls, ip: IPv4Address):
         """
-        Loads a PingList from a json File based on the ip address
+        Loads a PingList from the ping log based on the ip address
+        migrates an existing File of older versions to the ping log
         automatically instantiates an empty instance of the PingList if it doesn't exist
 
         Args:
@@ -108,42 +171,104 @@ class PingList(BaseModel):
         Returns:
             an instance of the PingList class representing the last ping events for the given ip
         """
-        filename = str(ip) + ".json"
+        filename = str(ip) + ".ndjson"
         try:
-            with open(filename, "r") as listfile:
-                return cls.model_validate_json(listfile.read())
-
+            with open(filename, "rb") as listfile:
+                content = listfile.read()
         except FileNotFoundError:
-            log.error("File %s not found or not readable. Creating empty pinglist instead.", filename)
-            return cls(target=ip)
-        except ValueError:
+            return cls.migrate_legacy(ip)
+        lines = content.splitlines()
+        # every complete event ends with a newline, anything after the last one is an interrupted append
+        torn_tail = not content.endswith(b"\n") and len(lines) > 0
+        if torn_tail:
+            log.warning(f"Discarding incomplete last line of {filename}")
+            lines.pop()
+        try:
+            # only the latest MAX_PINGS events are relevant, older lines are dropped on the next compaction
+            events = [PINGEVENT_DECODER.decode(line) for line in lines[-MAX_PINGS:] if line]
+        except (msgspec.DecodeError, ValueError):
             backup_file_name: str = filename + "." + str(int(datetime.timestamp(datetime.now())))
             # backup old file to [oldfilename].[timestamp]
             shutil.move(filename, backup_file_name)
-            log.error("Invalid JSON. Creating empty pinglist instead. Old file moved to %s", backup_file_name)
+            log.error("Invalid ping log. Creating empty pinglist instead. Old file moved to %s", backup_file_name)
             return cls(target=ip)
+        this_pinglist = cls(ip, events)
+        this_pinglist._logged_events = len(lines)
+        # appending after the incomplete line would corrupt the next event, so the log is rewritten instead
+        this_pinglist._rewrite_log = torn_tail
+        return this_pinglist
+
+    @classmethod
+    def migrate_legacy(cls, ip: IPv4Address):
+        """
+        Loads a PingList from the MessagePack or json File used by older versions and saves it to the ping log
+        automatically instantiates an empty instance of the PingList if it doesn't exist
+
+        Args:
+            ip: ip address of the PingList to migrate
+        Returns:
+            an instance of the PingList class representing the last ping events for the given ip
+        """
+        for extension, decoder in LEGACY_DECODERS:
+            filename = str(ip) + extension
+            try:
+                with open(filename, "rb") as listfile:
+                    schema = decoder.decode(listfile.read())
+                this_pinglist = cls(schema.target, schema.pings)
+            except FileNotFoundError:
+                continue
+            except (msgspec.DecodeError, ValueError):
+                backup_file_name: str = filename + "." + str(int(datetime.timestamp(datetime.now())))
+                # backup old file to [oldfilename].[timestamp]
+                shutil.move(filename, backup_file_name)
+                log.error("Invalid %s. Old file moved to %s", filename, backup_file_name)
+                continue
+            # none of the migrated pings are in the ping log yet
+            this_pinglist._pending.extend(this_pinglist._events)
+            this_pinglist.save()
+            backup_file_name: str = filename + "." + str(int(datetime.timestamp(datetime.now())))
+            # backup old file to [oldfilename].[timestamp]
+            shutil.move(filename, backup_file_name)
+            log.info(f"Migrated {filename} to the ping log. Old file moved to {backup_file_name}")
+            return this_pinglist
+        log.error("File %s not found or not readable. Creating empty pinglist instead.", str(ip) + ".ndjson")
+        return cls(target=ip)
 
     @classmethod
     def clear(cls, ip: IPv4Address):
         """
-        Clears the PingList from a json File based on the ip and saves it
+        Clears the ping log based on the ip
         Args:
              ip: ip address of the PingList to clear
         """
-        this_pinglist = cls.load(ip)
-        this_pinglist.pings = []
-        log.info(f"Cleared pings on {this_pinglist.target}")
-        filename = str(ip) + ".json"
+        filename = str(ip) + ".ndjson"
         backup_file_name: str = filename + "." + str(int(datetime.timestamp(datetime.now())))
         log.debug(f"Moving {filename} to {backup_file_name}")
-        # backup old file to [oldfilename].[timestamp]
-        shutil.move(filename, backup_file_name)
-        this_pinglist.save()
+        try:
+            # backup old file to [oldfilename].[timestamp]
+            shutil.move(filename, backup_file_name)
+        except FileNotFoundError:
+            log.debug(f"{filename} does not exist. Nothing to back up")
+        # an empty ping log is an empty PingList, there is no need to load the old pings
+        open(filename, "wb").close()
+        log.info(f"Cleared pings on {ip}")
 
     def save(self):
         """
-        Saves the current instance of the PingList to a json file named with the target ip
+        Appends the pings added since the last load or save to the ping log named with the target ip
+        once the log holds more than COMPACT_AFTER events it is rewritten with only the current pings
         """
-        filename = str(self.target) + ".json"
-        with open(filename, "w+") as listfile:
-            listfile.write(self.model_dump_json())
+        filename = str(self.target) + ".ndjson"
+        if self._rewrite_log or self._logged_events + len(self._pending) > COMPACT_AFTER:
+            # write to a temporary file and rename it, so a crash never leaves a half written log behind
+            temp_file_name = filename + ".tmp"
+            with open(temp_file_name, "wb") as listfile:
+                listfile.write(PINGEVENT_ENCODER.encode_lines(list(self._events)))
+            os.replace(temp_file_name, filename)
+            self._logged_events = len(self._events)
+            self._rewrite_log = False
+        else:
+            with open(filename, "ab") as listfile:
+                listfile.write(PINGEVENT_ENCODER.encode_lines(self._pending))
+            self._logged_events += len(self._pending)
+        self._pending.clear()
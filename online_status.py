@@ -1,11 +1,14 @@
-import datetime
-import json
-from json import JSONDecodeError
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from data_models import PingList
-from pydantic.networks import IPv4Address
+from ipaddress import IPv4Address
 import ping3
 from yaml import safe_load
 import requests
@@ -26,6 +29,34 @@ if isinstance(loglevel, int):
 
 log.addHandler(logging.StreamHandler())
 
+# ip addresses to check, converted once at startup
+LOCAL_IPS: tuple[IPv4Address, ...] = tuple(IPv4Address(ip) for ip in config["check_ips"]["local"])
+GLOBAL_IPS: tuple[IPv4Address, ...] = tuple(IPv4Address(ip) for ip in config["check_ips"]["global"])
+# a restart is triggered if strictly more than half of the ips of one kind failed.
+# for a whole number of failed ips "> n // 2" is the same as "> 0.5 * n"
+LOCAL_THRESHOLD: int = len(LOCAL_IPS) // 2
+GLOBAL_THRESHOLD: int = len(GLOBAL_IPS) // 2
+
+# load redfish credentials from login.yml
+USER_DETAILS = safe_load(open("login.yml", "r"))
+REDFISH_AUTH = HTTPBasicAuth(username=USER_DETAILS['user'], password=USER_DETAILS['password'])
+REDFISH_RESET_URL = (f"{config['opnsense_ipmi']['protocol']}://{config['opnsense_ipmi']['ip']}:"
+                     f"{config['opnsense_ipmi']['port']}/redfish/v1/Systems/Self/Actions/ComputerSystem.Reset")
+
+# the modification time of this file is the time of the last successful reset
+LAST_RESET_FILE = "lastreset.sentinel"
+try:
+    LAST_RESET_TS: Optional[float] = os.path.getmtime(LAST_RESET_FILE)
+except OSError:
+    log.debug(f"Could not get last reset time from {LAST_RESET_FILE}. File does not exist.")
+    LAST_RESET_TS = None
+
+# one keep-alive connection to the ipmi, reused by all redfish requests
+REDFISH_SESSION = requests.Session()
+REDFISH_SESSION.auth = REDFISH_AUTH
+REDFISH_SESSION.verify = False
+REDFISH_SESSION.mount(REDFISH_RESET_URL, HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
 
 def ping_wrapper(ip: IPv4Address) -> tuple[bool, float]:
     """
@@ -49,50 +80,41 @@ def ping_wrapper(ip: IPv4Address) -> tuple[bool, float]:
         return True, 99999999
 
 
-def check_ip(ip: IPv4Address):
+def check_ip(ip: IPv4Address) -> bool:
     """
     Checks if the given IP address is reachable and writes the ping result to the according PingList
 
     Args:
         ip: ip address to ping
+
+    Returns:
+        True if the ip failed the last tests; False otherwise
     """
     pinglist = PingList.load(ip)
     failed, latency = ping_wrapper(ip)
     pinglist.add_ping(latency=latency, failure=failed)
     pinglist.save()
+    # evaluate the PingList while it is still in memory instead of loading it again
+    return pinglist.did_latest_fail() and pinglist.get_valid_percentage() < 0.5
 
 
-def check_all_ips():
+def check_all_ips() -> dict:
     """
     Checks all IP addresses given in config file
-    """
-    for ip in config["check_ips"]["local"]:
-        check_ip(ip)
-    for ip in config["check_ips"]["global"]:
-        check_ip(ip)
-
-
-def get_failed_ips() -> dict:
-    """
-    Returns a dictionary with all the ip addresses that failed the last tests
 
     Returns:
          dict: dictionary with all the ip addresses that failed the last tests.
          the dict is seperated in local and global ips
     """
-    failed = {
-        "local": [],
-        "global": []
+    all_ips = [*LOCAL_IPS, *GLOBAL_IPS]
+    # pings are mostly waiting on the network, so all ips are checked in parallel.
+    # every ip has its own PingList file, so the threads don't share any state
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(all_ips)))) as executor:
+        results = list(executor.map(check_ip, all_ips))
+    return {
+        "local": [ip for ip, failed in zip(LOCAL_IPS, results) if failed],
+        "global": [ip for ip, failed in zip(GLOBAL_IPS, results[len(LOCAL_IPS):]) if failed]
     }
-    for ip in config["check_ips"]["local"]:
-        pinglist = PingList.load(ip)
-        if pinglist.did_latest_fail() and pinglist.get_valid_percentage() < 0.5:
-            failed["local"].append(ip)
-    for ip in config["check_ips"]["global"]:
-        pinglist = PingList.load(ip)
-        if pinglist.did_latest_fail() and pinglist.get_valid_percentage() < 0.5:
-            failed["global"].append(ip)
-    return failed
 
 
 def reset_opnsense():
@@ -103,65 +125,52 @@ def reset_opnsense():
     if config["no_restart"]:
         log.warning("no_restart is true, not restarting")
         return
-    try:
-        # check if since last reset enough time to satisfy the delay has passed
-        with open("lastreset.json", "r") as lastresetfile:
-            log.debug("Loading last reset time from lastreset.json")
-            lastreset = json.load(lastresetfile)
-            log.debug(f"Last reset was at {lastreset}")
-            difference = datetime.datetime.now() - datetime.datetime.fromtimestamp(lastreset)
-            if difference < datetime.timedelta(minutes=config["reset_delay"]):
-                log.info(
-                    f"Last reset was only {difference.total_seconds()} seconds ago (Less than {config['reset_delay']} Minutes). Skipping Reset.")
-                return
-    except FileNotFoundError:
-        log.debug("Could not get last reset time from lastreset.json. File does not exist.")
-        pass
-    except JSONDecodeError:
-        log.debug("Could not parse JSON from lastreset.json. File does not exist.")
-        pass
-
-    ipmi_details = config["opnsense_ipmi"]
-    # load redfish credentials from login.yml
-    user_details = safe_load(open("login.yml", "r"))
+    global LAST_RESET_TS
+    # check if since last reset enough time to satisfy the delay has passed
+    if LAST_RESET_TS is not None:
+        log.debug(f"Last reset was at {LAST_RESET_TS}")
+        difference = time.time() - LAST_RESET_TS
+        if difference < config["reset_delay"] * 60:
+            log.info(
+                f"Last reset was only {difference} seconds ago (Less than {config['reset_delay']} Minutes). Skipping Reset.")
+            return
+
     # make request to redfish api to Restart the server
-    resp: requests.Response = requests.post(
-        f"{ipmi_details['protocol']}://{ipmi_details['ip']}:{ipmi_details['port']}/redfish/v1/Systems/Self/Actions/ComputerSystem.Reset",
-        json={"ResetType": ipmi_details["reset_type"]}, verify=False,
-        auth=HTTPBasicAuth(username=user_details['user'], password=user_details['password']))
+    resp: requests.Response = REDFISH_SESSION.post(
+        REDFISH_RESET_URL, json={"ResetType": config["opnsense_ipmi"]["reset_type"]})
     if resp.status_code > 299:
         log.error("Could not reset opnsense successfully.")
         log.info("Reason: " + resp.text)
     else:
         clear_all_ips()
-        json.dump(datetime.datetime.timestamp(datetime.datetime.now()), open("lastreset.json", "w"))
-        log.debug("Wrote current timestamp to lastreset.json")
+        Path(LAST_RESET_FILE).touch()
+        LAST_RESET_TS = time.time()
+        log.debug(f"Touched {LAST_RESET_FILE} to store the reset time")
         log.info("Successfully reset opnsense.")
     log.debug("Got Response from IPMI: " + str(resp.json()))
 
 
 def clear_all_ips():
     log.debug("Clearing all IPs")
-    for ip in config["check_ips"]["local"]:
-        log.debug("Clearing IP: " + ip)
-        PingList.clear(IPv4Address(ip))
-    for ip in config["check_ips"]["global"]:
-        log.debug("Clearing IP: " + ip)
-        PingList.clear(IPv4Address(ip))
+    for ip in LOCAL_IPS:
+        log.debug(f"Clearing IP: {ip}")
+        PingList.clear(ip)
+    for ip in GLOBAL_IPS:
+        log.debug(f"Clearing IP: {ip}")
+        PingList.clear(ip)
 
 
 if __name__ == '__main__':
-    check_all_ips()
-    failed_ips = get_failed_ips()
+    failed_ips = check_all_ips()
     if len(failed_ips["global"]) > 0 and len(failed_ips["local"]) > 0:
         log.error("At least one global and one local ip failed. Restarting OPNSense...")
         reset_opnsense()
         exit(0)
-    if len(failed_ips["global"]) > 0.5 * len(config["check_ips"]["global"]):
+    if len(failed_ips["global"]) > GLOBAL_THRESHOLD:
         log.error("More than half of all global ips failed. Restarting OPNSense...")
         reset_opnsense()
         exit(0)
-    if len(failed_ips["local"]) > 0.5 * len(config["check_ips"]["local"]):
+    if len(failed_ips["local"]) > LOCAL_THRESHOLD:
         log.error("More than half of all local ips failed. Restarting OPNSense...")
         reset_opnsense()
         exit(0)